@@ -1,9 +1,16 @@
 """An implementation of the Entity Component System (ECS) paradigm."""
 
 from itertools import repeat as _repeat
+from itertools import chain as _chain
 
 __version__ = '1.2.1'
 
+def _duplicateTypes(comps):
+    """Internal function to list the component types that occur more than once among the given components, for use in exception messages."""
+
+    comptypes = [type(comp) for comp in comps]
+    return ', '.join(str(ct) for ct in dict.fromkeys(comptypes) if comptypes.count(ct) > 1)
+
 class CommandBuffer():
     """A buffer that stores commands and plays them back later.
 
@@ -44,11 +51,23 @@ class CommandBuffer():
         self.commands.append((self.scene.add, (eid, *comps)))
 
     def set(self, eid, *comps):
-        """Set components of an entity. The componentes will not be set immediately, but when the buffer is flushed. In particular, exception do not ossur when calling this method, but only when the buffer if flushed.
+        """Set components of an entity. The componentes will not be set immediately, but when the buffer is flushed. In particular, exception do not ossur when calling this method, but only when the buffer if flushed. Consecutive calls for the same entity (including the creation of the entity using *new()*) are merged, so that the entity is only moved once when the buffer is flushed.
 
         *New in version 1.2.*
         """
 
+        # merge with the previous command if it also sets components of this entity
+        # commands with duplicate component types are not merged, so that they still raise when flushing
+        if self.commands:
+            cmd, args = self.commands[-1]
+            if args[0] == eid and (cmd == self.scene.set or cmd == self.scene.new):
+                compdict = {type(comp): comp for comp in args[1:]}
+                newcompdict = {type(comp): comp for comp in comps}
+                if len(compdict) == len(args) - 1 and len(newcompdict) == len(comps):
+                    compdict.update(newcompdict)
+                    self.commands[-1] = (cmd, (eid, *compdict.values()))
+                    return
+
         self.commands.append((self.scene.set, (eid, *comps)))
 
     def remove(self, eid, *comptypes):
@@ -83,60 +102,75 @@ class Scene():
 
     def __init__(self):
         self.entitymap = {} # {eid: (archetype, index)}
-        self.archetypemap = {} # {component type: set(archetype)}
-        self.chunkmap = {} # {archetype: ([eid], {component type: [component]})}
+        self.chunkmap = {} # {archetype: ([eid], {component type: [component]}, bitmask)}
         self.lasteid = -1 # the last valid entity id
+        self.querymap = {} # {((component type, ...), (excluded component type, ...)): [([eid], ([component], ...))]}, cleared whenever a chunk is created or removed
+        self.internmap = {} # {archetype: (archetype, (component type, ...), [(component type, ...)])}, the unique archetype instance, the tuple returned by archetype() and the keys in keymap for each chunk
+        self.keymap = {} # {(component type, ...): archetype}, the archetype of each chunk by the component type tuples it was looked up with
+        self.bitmap = {} # {component type: bit}, assigned when the first chunk containing the component type is created
 
     def _removeEntity(self, eid):
         """Internal method to remove an entity. The entity id must be valid and in entitymap, i.e. the entity must have at least one component."""
 
         archetype, index = self.entitymap[eid]
-        eidlist, comptypemap = self.chunkmap[archetype]
+        eidlist, comptypemap, _ = self.chunkmap[archetype]
 
-        # remove the entity by swapping it with another entity, or ...
+        # remove the entity by swapping it with the last entity, or ...
         if len(eidlist) > 1:
-            swapid = eidlist[-1]
-            if swapid != eid: # do not replace with self
+            swapid = eidlist.pop()
+            if swapid != eid: # move the last entity into the free row
                 self.entitymap[swapid] = (archetype, index)
 
                 eidlist[index] = swapid
                 for complist in comptypemap.values():
-                    swapcomp = complist[-1]
-                    complist[index] = swapcomp
-
-            # remove swaped entity
-            eidlist.pop()
-            for complist in comptypemap.values():
-                complist.pop()
+                    complist[index] = complist.pop()
+            else: # the entity is the last one, simply drop it
+                for complist in comptypemap.values():
+                    complist.pop()
         else: # ... if the archetype container will be empty after this, remove it
-            for ct in archetype:
-                self.archetypemap[ct].remove(archetype)
-                if not self.archetypemap[ct]:
-                    del self.archetypemap[ct]
+            # empty the lists as well, since iterations that already hold them must not yield the removed entity
+            eidlist.clear()
+            for complist in comptypemap.values():
+                complist.clear()
             del self.chunkmap[archetype]
+            for key in self.internmap.pop(archetype)[2]:
+                del self.keymap[key]
+            self.querymap.clear()
 
         del self.entitymap[eid]
 
     def _addEntity(self, eid, compdict):
         """Internal method to add an entity. The entity id must be valid and the component list must be non-empty. Also, there must be a maximum of one component of each type."""
 
-        archetype = frozenset(compdict.keys())
-        if archetype in self.chunkmap: # collect unique instance from cache, if possible
-            archetype = next(iter(x for x in self.chunkmap if x == archetype))
-
-        # if there is no container for the new archetype, create one
-        if archetype not in self.chunkmap:
-            # add to chunkmap
-            self.chunkmap[archetype] = ([], {ct: [] for ct in archetype})
-
-            # add to archetypemap
-            for ct in archetype:
-                if ct not in self.archetypemap:
-                    self.archetypemap[ct] = set()
-                self.archetypemap[ct].add(archetype)
+        # collect the unique archetype instance, so that lookups can be resolved by identity
+        # the tuple of component types is cheaper to build and hash than the archetype itself
+        key = tuple(compdict)
+        archetype = self.keymap.get(key)
+        if archetype is None:
+            archetype = frozenset(key)
+            interned = self.internmap.get(archetype)
+
+            # if there is no container for the new archetype, create one, else ...
+            if interned is None:
+                # assign the next free bit to component types that have not been seen before
+                bitmap = self.bitmap
+                mask = 0
+                for ct in archetype:
+                    bit = bitmap.get(ct)
+                    if bit is None:
+                        bit = bitmap[ct] = 1 << len(bitmap)
+                    mask |= bit
+
+                self.chunkmap[archetype] = ([], {ct: [] for ct in archetype}, mask)
+                self.internmap[archetype] = (archetype, tuple(archetype), [key])
+                self.querymap.clear()
+            else: # ... remember the key for the existing archetype
+                archetype = interned[0]
+                interned[2].append(key)
+            self.keymap[key] = archetype
 
         # add the entity and components to the archetype container
-        eidlist, comptypemap = self.chunkmap[archetype]
+        eidlist, comptypemap, _ = self.chunkmap[archetype]
         eidlist.append(eid)
         for ct, c in compdict.items():
             comptypemap[ct].append(c)
@@ -145,6 +179,37 @@ class Scene():
         index = len(eidlist) - 1
         self.entitymap[eid] = (archetype, index)
 
+    def _matchChunks(self, comptypes, exclude):
+        """Internal method to collect the chunks of all archetypes that contain all of the component types in *comptypes* and none of the component types in *exclude*. Returns a list of tuples of the form `([eid], ([compA], [compB], ...))`, holding the entity id list and the component lists of the given types for each chunk. The include and exclude types are turned into bitmasks once, so that matching an archetype takes two integer operations. The result is cached until a chunk is created or removed and must not be modified."""
+
+        # return the cached chunks, if possible
+        key = (comptypes, tuple(exclude) if exclude else ())
+        chunks = self.querymap.get(key)
+        if chunks is not None:
+            return chunks
+
+        # component types without a bit are not part of any chunk, so no chunk matches if one of them is included, and excluding them has no effect
+        bitmap = self.bitmap
+        include = 0
+        for ct in comptypes:
+            bit = bitmap.get(ct)
+            if bit is None:
+                chunks = self.querymap[key] = []
+                return chunks
+            include |= bit
+        excludemask = 0
+        for ct in exclude or ():
+            excludemask |= bitmap.get(ct, 0)
+
+        # collect the lists of the matching chunks, they are never replaced for the lifetime of a chunk
+        chunks = self.querymap[key] = [(eidlist, tuple([comptypemap[ct] for ct in comptypes])) for eidlist, comptypemap, mask in self.chunkmap.values() if (mask & include) == include and not (mask & excludemask)]
+        return chunks
+
+    def _iterChunks(self, comptypes, exclude):
+        """Internal method to iterate over the result of *_matchChunks()*. The chunks are only collected once the iteration starts, so that changes made between creating and starting an iteration are taken into account."""
+
+        yield from self._matchChunks(comptypes, exclude)
+
     def buffer(self):
         """Return a new command buffer that is associated to this scene.
 
@@ -169,8 +234,7 @@ class Scene():
 
             # raise ValueError on trying to add duplicate component types
             if len(compdict) < len(comps):
-                comptypes = [type(comp) for comp in comps]
-                raise ValueError(f"adding duplicate component type(s): {', '.join(str(ct) for ct in comptypes if comptypes.count(ct) > 1)}")
+                raise ValueError(f"adding duplicate component type(s): {_duplicateTypes(comps)}")
 
             self._addEntity(self.lasteid, compdict)
 
@@ -184,14 +248,14 @@ class Scene():
             raise KeyError(f"invalid entity id: {eid}")
 
         # unpack entity
-        try:
-            archetype, index = self.entitymap[eid]
-            _, comptypemap = self.chunkmap[archetype]
-        except KeyError: # eid not in self.entitymap
+        entry = self.entitymap.get(eid)
+        if entry is None: # eid not in self.entitymap
             return []
+        archetype, index = entry
+        _, comptypemap, _ = self.chunkmap[archetype]
 
         # collect the components and remove the entity
-        components = [comptypemap[comptype][index] for comptype in comptypemap]
+        components = [complist[index] for complist in comptypemap.values()]
         self._removeEntity(eid)
 
         return components
@@ -204,13 +268,13 @@ class Scene():
             raise KeyError(f"invalid entity id: {eid}")
 
         # unpack entity
-        try:
-            archetype, index = self.entitymap[eid]
-            _, comptypemap = self.chunkmap[archetype]
-        except KeyError: # eid not in self.entitymap
+        entry = self.entitymap.get(eid)
+        if entry is None: # eid not in self.entitymap
             return ()
+        archetype, index = entry
+        _, comptypemap, _ = self.chunkmap[archetype]
 
-        return tuple(comptypemap[comptype][index] for comptype in comptypemap)
+        return tuple([complist[index] for complist in comptypemap.values()])
 
     def archetype(self, eid):
         """Returns the archetype of an entity. Raises *KeyError* if the entity id is not valid."""
@@ -220,12 +284,11 @@ class Scene():
             raise KeyError(f"invalid entity id: {eid}")
 
         # unpack entity
-        try:
-            archetype, _ = self.entitymap[eid]
-        except KeyError: # eid not in self.entitymap
+        entry = self.entitymap.get(eid)
+        if entry is None: # eid not in self.entitymap
             return ()
 
-        return tuple(archetype)
+        return self.internmap[entry[0]][1]
 
     def add(self, eid, *comps):
         """Add components to an entity. Returns the component(s) as a list if two or more components are given, or a single component instance if only one component is given. Raises *KeyError* if the entity id is not valid or *ValueError* if the entity would have one or more components of the same type after this operation or no components are supplied to the method.
@@ -242,25 +305,27 @@ class Scene():
         if not comps:
             raise ValueError("missing input")
 
+        # sort components by type
+        compdict = {type(comp): comp for comp in comps}
+
         # raise ValueError if trying to add duplicate component types
-        if len(set(type(comp) for comp in comps)) < len(comps):
-            comptypes = [type(comp) for comp in comps]
-            raise ValueError(f"adding duplicate component type(s): {', '.join(str(ct) for ct in comptypes if comptypes.count(ct) > 1)}")
+        if len(compdict) < len(comps):
+            raise ValueError(f"adding duplicate component type(s): {_duplicateTypes(comps)}")
 
-        complist = list(comps)
-        if eid in self.entitymap:
-            archetype, index = self.entitymap[eid]
-            _, comptypemap = self.chunkmap[archetype]
+        entry = self.entitymap.get(eid)
+        if entry is not None:
+            archetype, index = entry
+            _, comptypemap, _ = self.chunkmap[archetype]
 
             # raise ValueError if trying to add component types that are already present
-            if any(type(comp) in comptypemap for comp in comps):
+            if not archetype.isdisjoint(compdict):
                 raise ValueError(f"component type(s) already present: {', '.join(str(type(comp)) for comp in comps if type(comp) in comptypemap)}")
 
-            # collect old components and remove the entity
-            complist.extend(comptypemap[comptype][index] for comptype in comptypemap)
+            # collect old components and remove the entity, so that it is moved to its new chunk at once
+            for ct, complist in comptypemap.items():
+                compdict[ct] = complist[index]
             self._removeEntity(eid)
 
-        compdict = {type(c): c for c in complist}
         self._addEntity(eid, compdict)
 
         if len(comps) == 1:
@@ -287,13 +352,13 @@ class Scene():
 
         # raise ValueError if trying to set duplicate component types
         if len(compdict) < len(comps):
-            comptypes = list(compdict.keys())
-            raise ValueError(f"duplicate component type(s): {', '.join(str(ct) for ct in comptypes if comptypes.count(ct) > 1)}")
+            raise ValueError(f"duplicate component type(s): {_duplicateTypes(comps)}")
 
         # Modify entity if already presend, else ...
-        if eid in self.entitymap:
-            archetype, index = self.entitymap[eid]
-            _, comptypemap = self.chunkmap[archetype]
+        entry = self.entitymap.get(eid)
+        if entry is not None:
+            archetype, index = entry
+            _, comptypemap, _ = self.chunkmap[archetype]
 
             oldcompdict = {ct: comptypemap[ct][index] for ct in comptypemap}
 
@@ -323,13 +388,11 @@ class Scene():
             raise ValueError("missing input")
 
         # unpack entity
-        try:
-            archetype, _ = self.entitymap[eid]
-            _, comptypemap = self.chunkmap[archetype]
-        except KeyError: # eid not in self.entitymap
+        entry = self.entitymap.get(eid)
+        if entry is None: # eid not in self.entitymap
             return False
 
-        return all(ct in comptypemap for ct in comptypes)
+        return entry[0].issuperset(comptypes)
 
     def collect(self, eid, *comptypes):
         """Collect multiple components of an entity. Returns a list of the components. Raises *KeyError* if the entity id is not valid or *ValueError* if a component of any of the requested types is missing.
@@ -348,7 +411,7 @@ class Scene():
         # unpack entity
         try:
             archetype, index = self.entitymap[eid]
-            _, comptypemap = self.chunkmap[archetype]
+            _, comptypemap, _ = self.chunkmap[archetype]
         except KeyError: # eid not in self.entitymap
             raise ValueError(f"missing component type(s): {', '.join(str(ct) for ct in comptypes)}")
 
@@ -369,7 +432,7 @@ class Scene():
         # unpack entity
         try:
             archetype, index = self.entitymap[eid]
-            _, comptypemap = self.chunkmap[archetype]
+            _, comptypemap, _ = self.chunkmap[archetype]
         except KeyError: # eid not in self.entitymap
             raise ValueError(f"missing component type: {str(comptype)}")
 
@@ -396,22 +459,25 @@ class Scene():
         # unpack entity
         try:
             archetype, index = self.entitymap[eid]
-            _, comptypemap = self.chunkmap[archetype]
+            _, comptypemap, _ = self.chunkmap[archetype]
         except KeyError: # eid not in self.entitymap
             raise ValueError(f"missing component type(s): {', '.join(str(ct) for ct in comptypes)}")
 
         # raise ValueError if the entity does not have the requested component types
-        if not all(ct in comptypemap for ct in comptypes):
+        if not archetype.issuperset(comptypes):
             raise ValueError(f"missing component type(s): {', '.join(str(ct) for ct in comptypes if ct not in comptypemap)}")
 
-        # collect components that will remain on the entity and the ones to be removed
-        compdict = {ct: comptypemap[ct][index] for ct in comptypemap if ct not in comptypes}
-        removed = list(comptypemap[ct][index] for ct in comptypes)
+        # collect the components to be removed and the types of the ones that will remain on the entity
+        removed = [comptypemap[ct][index] for ct in comptypes]
+        remaining = comptypemap.keys() - comptypes
 
-        # remove the entity and add it back if there are remaining components
-        self._removeEntity(eid)
-        if compdict:
+        # move the entity to the chunk of the remaining components, or ...
+        if remaining:
+            compdict = {ct: comptypemap[ct][index] for ct in remaining}
+            self._removeEntity(eid)
             self._addEntity(eid, compdict)
+        else: # ... if no components remain, only remove it from its chunk
+            self._removeEntity(eid)
 
         if len(removed) == 1:
             return removed[0]
@@ -445,19 +511,25 @@ class Scene():
         if exclude and any(ct in exclude for ct in comptypes):
             raise ValueError(f"excluding explicitely included component types: {', '.join(str(x) for x in set(comptypes).intersection(exclude))}")
 
-        # collect archetypes that should be included and archetypes that should be excluded
-        incarchetypes = set.intersection(*[self.archetypemap.get(ct, set()) for ct in comptypes]) if comptypes else set(self.chunkmap.keys())
-        excarchetypes = set.union(*[self.archetypemap.get(ct, set()) for ct in exclude]) if exclude else set()
-
         # iterate over all included archetype that are not excluded
         # the iteration is reversed, because this will yield better performance when calling e.g. scene.remove() on the result.
-        archetypes = incarchetypes - excarchetypes
+        chunks = self._iterChunks(comptypes, exclude)
         if comptypes:
-            for archetype in archetypes:
-                eidlist, comptypemap = self.chunkmap[archetype]
-                complists = [reversed(comptypemap[ct]) for ct in comptypes]
-                yield from zip(reversed(eidlist), zip(*complists))
+            return _chain.from_iterable(zip(reversed(eidlist), zip(*map(reversed, columns))) for eidlist, columns in chunks)
         else:
-            for archetype in archetypes:
-                eidlist, _ = self.chunkmap[archetype]
-                yield from zip(reversed(eidlist), _repeat(()))
+            empty = _repeat(())
+            return _chain.from_iterable(zip(reversed(eidlist), empty) for eidlist, _ in chunks)
+
+    def chunks(self, *comptypes, exclude=None):
+        """Iterate over chunks of entities that share the same archetype. Yields tuples of the form `(eids, (compsA, compsB, ...))` where `eids` is a tuple of entity ids and `compsA`, `compsB`, ... are tuples of components of the given types, such that `compsA[i]` belongs to the entity with entity id `eids[i]`. The entities selected are the same as with *select()*. The tuples are copies of the internal storage of the scene taken when the chunk is reached, so they do not reflect later changes to the scene. Raises *ValueError* if *exclude* contains component types that are also explicitly included.
+
+        *New in version 1.3.*
+        """
+
+        # raise ValueError if trying to exclude component types that are also included
+        if exclude and any(ct in exclude for ct in comptypes):
+            raise ValueError(f"excluding explicitely included component types: {', '.join(str(x) for x in set(comptypes).intersection(exclude))}")
+
+        # copy the lists of each chunk, so that the internal storage of the scene is never exposed
+        # chunks that have been removed since the iteration started are empty and skipped
+        return ((tuple(eidlist), tuple([tuple(complist) for complist in columns])) for eidlist, columns in self._iterChunks(comptypes, exclude) if eidlist)
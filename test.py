@@ -1,50 +1,58 @@
 import unittest
-from mecs import Scene
+from mecs import Scene, CommandBuffer
 
 class ComponentA():
+    __slots__ = ('a',)
+
     def __init__(self, a):
         self.a = a
 
 class ComponentB():
+    __slots__ = ('b',)
+
     def __init__(self, b):
         self.b = b
 
 class SystemA():
     def update(self, scene, **kwargs):
-        for eid, (a,) in scene.filter(ComponentA):
-            a.a += 1
+        for eids, (compsA,) in scene.chunks(ComponentA):
+            for a in compsA:
+                a.a += 1
 
     init = update
     destroy = update
 
 class SystemB():
     def update(self, scene, **kwargs):
-        for eid, (b,) in scene.filter(ComponentB):
-            b.b += 1
+        for eids, (compsB,) in scene.chunks(ComponentB):
+            for b in compsB:
+                b.b += 1
 
     init = update
     destroy = update
 
 class SystemAandB():
     def update(self, scene, **kwargs):
-        for ent, (a, b) in scene.filter(ComponentA, ComponentB):
-            a.a += 1
-            b.b += 1
+        for eids, (compsA, compsB) in scene.chunks(ComponentA, ComponentB):
+            for a, b in zip(compsA, compsB):
+                a.a += 1
+                b.b += 1
 
     init = update
     destroy = update
 
 class SystemAnotB():
     def update(self, scene, **kwargs):
-        for ent, (a,) in scene.filter(ComponentA, exclude=(ComponentB,)):
-            a.a += 1
+        for eids, (compsA,) in scene.chunks(ComponentA, exclude=(ComponentB,)):
+            for a in compsA:
+                a.a += 1
 
     init = update
     destroy = update
 
 class SystemValueError():
     def update(self, scene, **kwargs):
-        for ent, (a, b) in scene.filter(ComponentA, ComponentB, exclude=(ComponentB,)):
+        for ent, (a, b) in scene.select(ComponentA, ComponentB, exclude=(ComponentB,)):
             a.a += 1
             a.b += 1
 
@@ -73,6 +81,23 @@ class CommandBufferTestCase(unittest.TestCase):
             seen = self.scene.has(eid, ComponentB)
         self.assertTrue(seen)
 
+    def test_set(self):
+        componentA2 = ComponentA(0)
+        with CommandBuffer(self.scene) as buffer:
+            eid = buffer.new(self.componentA)
+            buffer.set(eid, self.componentB)
+            buffer.set(eid, componentA2)
+            self.assertEqual(len(buffer.commands), 1)
+
+        (eid, (compA, compB)), = self.scene.select(ComponentA, ComponentB)
+        self.assertEqual((compA, compB), (componentA2, self.componentB))
+
+        # duplicate component types still raise when flushing
+        buffer = CommandBuffer(self.scene)
+        buffer.set(eid, self.componentA)
+        buffer.set(eid, self.componentB, self.componentB)
+        self.assertRaises(ValueError, buffer.flush)
+
 class SceneTestCase(unittest.TestCase):
     def setUp(self):
         self.scene = Scene()
@@ -97,12 +122,12 @@ class SceneTestCase(unittest.TestCase):
 
     def test_new_A(self):
         # new entity id
-        used = []
+        used = set()
         for _ in range(10):
             eid = self.scene.new()
             self.assertFalse(eid in used)
 
-            used.append(eid)
+            used.add(eid)
 
     def test_new_B(self):
         # adding components
@@ -333,6 +358,8 @@ class SceneTestCase(unittest.TestCase):
         self.assertRaises(ValueError, self.scene.set, self.eid, self.componentB1, self.componentB2)
         self.assertRaises(ValueError, self.scene.set, self.eid, self.componentA1, self.componentA2, self.componentB)
         self.assertRaises(ValueError, self.scene.set, self.eid, self.componentA, self.componentB1, self.componentB2)
+        self.assertRaisesRegex(ValueError, 'ComponentA', self.scene.set, self.eid, self.componentA1, self.componentA2)
+        self.assertRaisesRegex(ValueError, 'ComponentB', self.scene.set, self.eid, self.componentA, self.componentB1, self.componentB2)
 
     def test_has_A(self):
         # case has no components
@@ -638,12 +665,112 @@ class SceneTestCase(unittest.TestCase):
         for eid, compA in zip(resulteid, resultcompA):
             self.assertEqual(self.scene.get(eid, ComponentA), compA)
 
+        self.systemAnotB.update(self.scene)
+        self.assertEqual((self.componentA1.a, self.componentA2.a, self.componentA3.a), (1, 1, 0))
+
+    def test_select_E(self):
+        # case new and removed archetypes between two selections
+        self.scene.add(self.eid1, self.componentA1)
+        self.assertEqual([eid for eid, _ in self.scene.select(ComponentA)], [self.eid1])
+
+        self.scene.add(self.eid2, self.componentA2, self.componentB2)
+        self.assertEqual(set(eid for eid, _ in self.scene.select(ComponentA)), set((self.eid1, self.eid2)))
+
+        self.scene.remove(self.eid1, ComponentA)
+        self.assertEqual([eid for eid, _ in self.scene.select(ComponentA)], [self.eid2])
+
+    def test_select_F(self):
+        # case a chunk that has not been reached yet is removed during the selection
+        self.scene.add(self.eid1, self.componentA1)
+        self.scene.add(self.eid2, self.componentA2, self.componentB2)
+        self.scene.add(self.eid3, self.componentA3, self.componentB3)
+
+        resulteid = []
+        for eid, (compA,) in self.scene.select(ComponentA):
+            resulteid.append(eid)
+            if eid == self.eid1:
+                self.scene.free(self.eid2)
+                self.scene.free(self.eid3)
+        self.assertEqual(resulteid, [self.eid1])
+
+    def test_select_G(self):
+        # case entities added after the selection is created, but before it is iterated
+        self.scene.add(self.eid1, self.componentA1)
+        selection = self.scene.select(ComponentA)
+        chunks = self.scene.chunks(ComponentA)
+        self.scene.add(self.eid2, self.componentA2, self.componentB2)
+
+        self.assertEqual(set(eid for eid, _ in selection), set((self.eid1, self.eid2)))
+        self.assertEqual(set(eid for eids, _ in chunks for eid in eids), set((self.eid1, self.eid2)))
+
     def test_select_XA(self):
         # ValueError
-        #self.assertRaises(ValueError, self.scene.filter, ComponentA, ComponentB, exclude=(ComponentA,))
+        self.assertRaises(ValueError, self.scene.select, ComponentA, ComponentB, exclude=(ComponentA,))
         with self.assertRaises(ValueError):
             next(iter(self.scene.select(ComponentA, ComponentB, exclude=(ComponentA,)))) # use generator to raise exception
+        self.assertRaises(ValueError, SystemValueError().update, self.scene)
 
+    def test_chunks_A(self):
+        # case two components, exclude one
+        self.scene.add(self.eid1, self.componentA1)
+        self.scene.add(self.eid2, self.componentA2)
+        self.scene.add(self.eid3, self.componentA3, self.componentB3)
+
+        resulteid = []
+        resultcompA = []
+        for eids, (compsA,) in self.scene.chunks(ComponentA, exclude=(ComponentB,)):
+            self.assertEqual(len(eids), len(compsA))
+            resulteid.extend(eids)
+            resultcompA.extend(compsA)
+        self.assertEqual(set(resulteid), set((self.eid1, self.eid2)))
+        self.assertEqual(set(resultcompA), set((self.componentA1, self.componentA2)))
+        for eid, compA in zip(resulteid, resultcompA):
+            self.assertEqual(self.scene.get(eid, ComponentA), compA)
+
+    def test_chunks_B(self):
+        # case system update over chunks
+        self.scene.add(self.eid1, self.componentA1, self.componentB1)
+        self.scene.add(self.eid2, self.componentA2)
+
+        SystemAandB().update(self.scene)
+        self.assertEqual((self.componentA1.a, self.componentB1.b), (1, 1))
+        self.assertEqual(self.componentA2.a, 0)
+
+        self.systemA.update(self.scene)
+        self.assertEqual((self.componentA1.a, self.componentA2.a), (2, 1))
+
+        self.systemB.update(self.scene)
+        self.assertEqual(self.componentB1.b, 2)
+
+    def test_chunks_C(self):
+        # case chunks are copies of the internal storage
+        eids = [self.scene.new(ComponentA(0)) for _ in range(5)]
+
+        visited = []
+        for chunkeids, (compsA,) in self.scene.chunks(ComponentA):
+            self.assertIsInstance(chunkeids, tuple)
+            self.assertIsInstance(compsA, tuple)
+            for eid in chunkeids:
+                self.scene.remove(eid, ComponentA)
+                visited.append(eid)
+        self.assertEqual(set(visited), set(eids))
+        self.assertEqual(list(self.scene.chunks(ComponentA)), [])
+
+        # case a chunk that has not been reached yet is removed
+        self.scene.add(self.eid1, self.componentA1)
+        self.scene.add(self.eid2, self.componentA2, self.componentB2)
+
+        visited = []
+        for chunkeids, (compsA,) in self.scene.chunks(ComponentA):
+            visited.extend(chunkeids)
+            self.scene.free(self.eid2)
+        self.assertEqual(visited, [self.eid1])
+
+    def test_chunks_XA(self):
+        # ValueError
+        self.assertRaises(ValueError, self.scene.chunks, ComponentA, ComponentB, exclude=(ComponentA,))
+        with self.assertRaises(ValueError):
+            next(iter(self.scene.chunks(ComponentA, ComponentB, exclude=(ComponentA,)))) # use generator to raise exception
 
 if __name__ == "__main__":
     unittest.main()